@@ -1,18 +1,31 @@
 from dotenv import load_dotenv
 load_dotenv() # .envファイルから環境変数を読み込む
 
-from fastapi import FastAPI, HTTPException, status
+from fastapi import FastAPI, HTTPException, Response, status
+from fastapi.concurrency import run_in_threadpool
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel, Field, ConfigDict # ConfigDictをインポート
+from fastapi.responses import ORJSONResponse
+from pydantic import BaseModel, Field, ConfigDict, TypeAdapter # ConfigDictをインポート
 import gspread
+from gspread.utils import rowcol_to_a1
 import qrcode
+import qrcode.image.pure
+from cachetools import TTLCache
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from io import BytesIO
 import base64
-import datetime
+import functools
+import logging
+import secrets
+import threading
+import time
 from typing import Optional, List, Literal 
 import os
 import json
 
+logger = logging.getLogger(__name__)
+
 # 環境変数から設定を読み込む
 SPREADSHEET_ID = os.getenv("SPREADSHEET_ID")
 MASTER_SHEET_NAME = os.getenv("MASTER_SHEET_NAME")
@@ -21,14 +34,15 @@ MASTER_SHEET_NAME = os.getenv("MASTER_SHEET_NAME")
 origins_str = os.getenv("CORS_ORIGINS", "http://localhost:3000")
 origins = [o.strip() for o in origins_str.split(',') if o.strip()]
 
-app = FastAPI()
+app = FastAPI(default_response_class=ORJSONResponse)
 
 app.add_middleware(
     CORSMiddleware,
     allow_origins=origins,
     allow_credentials=True,
-    allow_methods=["*"],
-    allow_headers=["*"],
+    # ワイルドカードだとプリフライト毎にヘッダーを反射生成するため、実際に使うものだけ明示する
+    allow_methods=["GET", "POST", "PUT", "OPTIONS"],
+    allow_headers=["Content-Type", "Authorization"],
 )
 
 # Google Sheets認証
@@ -38,6 +52,11 @@ try:
         raise ValueError("SERVICE_ACCOUNT_FILE_JSON 環境変数が設定されていません。")
     service_account_info = json.loads(service_account_info_str)
     gc = gspread.service_account_from_dict(service_account_info)
+    # 同時リクエスト時にTLSハンドシェイクをやり直さないよう、コネクションプールを広げてkeep-aliveを効かせる
+    gc.http_client.session.mount(
+        "https://",
+        HTTPAdapter(pool_connections=20, pool_maxsize=20, max_retries=Retry(total=3, backoff_factor=0.2)),
+    )
     spreadsheet = gc.open_by_key(SPREADSHEET_ID)
     master_sheet = spreadsheet.worksheet(MASTER_SHEET_NAME)
 except Exception as e:
@@ -45,25 +64,124 @@ except Exception as e:
     print("サービスアカウントのJSON、スプレッドシートID、シート名、共有設定を確認してください。")
     exit(1)
 
-# QRコード生成関数 (変更なし)
-def generate_qr_code_base64(data: str) -> str:
-    qr = qrcode.QRCode(
-        version=1,
-        error_correction=qrcode.constants.ERROR_CORRECT_L,
-        box_size=10,
-        border=4,
-    )
-    qr.add_data(data)
-    qr.make(fit=True)
-    img = qr.make_image(fill_color="black", back_color="white")
+# ヘッダー行は実質的に静的なので、リクエスト毎にAPIを叩かず起動時に1回だけ取得してキャッシュする
+HEADER_ROW: List[str] = []
+STATUS_COL_INDEX = -1
+ID_COL_INDEX = -1
+LAST_COL_LETTER = ""
+
+def _load_headers():
+    """ヘッダー行と「状態」「工具治具ID」列の位置を取得してモジュール変数にキャッシュします。"""
+    global HEADER_ROW, STATUS_COL_INDEX, ID_COL_INDEX, LAST_COL_LETTER
+    HEADER_ROW = master_sheet.row_values(1)
+    STATUS_COL_INDEX = HEADER_ROW.index("状態") + 1  # Google Sheetsは1ベース
+    ID_COL_INDEX = HEADER_ROW.index("工具治具ID") + 1
+    # データ取得レンジ用に最終列の列文字（例: "K"）も出しておく
+    LAST_COL_LETTER = rowcol_to_a1(1, len(HEADER_ROW)).rstrip("0123456789")
+
+try:
+    _load_headers()
+except Exception as e:
+    print(f"ヘッダー行の取得に失敗しました: {e}")
+    print("スプレッドシートの1行目に「状態」列を含むヘッダーがあるか確認してください。")
+    exit(1)
+
+# 全レコードのTTLキャッシュ。フロントエンドのポーリングが毎回Sheets APIを叩かないようにする
+_records_cache = TTLCache(maxsize=1, ttl=30)
+
+def get_cached_records() -> List[dict]:
+    """全レコードをTTLキャッシュ経由で取得します。書き込み後は invalidate_records_cache() を呼ぶこと。
+
+    get_all_records() はヘッダーを再取得した上で行ごとにdictを組み立てるため、
+    生の2次元配列を取得してキャッシュ済みヘッダーとzipする方が軽い。
+    UNFORMATTED_VALUE なら数値セルはネイティブな数値で返る。
+    """
+    try:
+        return _records_cache[SPREADSHEET_ID]
+    except KeyError:
+        rows = master_sheet.get(f"A2:{LAST_COL_LETTER}", value_render_option="UNFORMATTED_VALUE")
+        records = [dict(zip(HEADER_ROW, row)) for row in rows]
+        _records_cache[SPREADSHEET_ID] = records
+        return records
+
+def invalidate_records_cache():
+    """シートへの書き込み成功後にレコードキャッシュを破棄します。"""
+    _records_cache.clear()
+
+# シートの日本語列名 → Pydanticフィールド名の対応表（インポート時に1回だけ構築）
+FIELD_MAP = [
+    ("id", "工具治具ID"),
+    ("name", "名称"),
+    ("modelNumber", "型番品番"),
+    ("type", "種類"),
+    ("storageLocation", "保管場所"),
+    ("status", "状態"),
+    ("purchaseDate", "購入日"),
+    ("purchasePrice", "購入価格"),
+    ("recommendedReplacement", "推奨交換時期"),
+    ("remarks", "備考"),
+    ("imageUrl", "画像URL"),
+]
+
+def _format_record(record: dict) -> dict:
+    """日本語キーのシートレコードをPydanticフィールド名のdictに整形します。"""
+    formatted = {eng: record.get(jp) for eng, jp in FIELD_MAP}
+    formatted["purchasePrice"] = _to_price(formatted["purchasePrice"])
+    return formatted
+
+def _to_price(value) -> float:
+    """シートの「購入価格」セル値をfloatに変換します。
+
+    gspreadのnumericiseにより数値セルはすでにint/floatで返るため、
+    その場合の再パースを避け、辞書参照も呼び出し側で1回に抑える。
+    """
+    if isinstance(value, (int, float)):
+        return float(value)
+    if isinstance(value, str) and value:
+        return float(value)
+    return 0.0
+
+# QRコード生成用のシングルトン。コンストラクタは内部の行列確保が重いので毎回作らない
+_QR = qrcode.QRCode(
+    version=1,
+    error_correction=qrcode.constants.ERROR_CORRECT_L,
+    box_size=10,
+    border=4,
+)
+_qr_lock = threading.Lock()
+
+# QRコード生成関数
+# tool_idは不変なので結果をLRUキャッシュする（無効化は不要、メモリは約4KB/件）
+@functools.lru_cache(maxsize=4096)
+def _qr_png_bytes(data: str) -> bytes:
+    """QRコードのPNGバイト列を生成します。"""
+    # シングルトンを使い回すので、クリア〜画像化まではロックで直列化する
+    with _qr_lock:
+        _QR.clear()
+        _QR.add_data(data)
+        _QR.make(fit=True)
+        # PILバックエンドはRGB画像の確保とlibpngエンコードが重いので、軽量なPyPNGバックエンドを使う
+        img = _QR.make_image(image_factory=qrcode.image.pure.PyPNGImage)
     buffered = BytesIO()
-    img.save(buffered, format="PNG")
-    img_str = base64.b64encode(buffered.getvalue()).decode("utf-8")
+    img.save(buffered)
+    return buffered.getvalue()
+
+@functools.lru_cache(maxsize=4096)
+def generate_qr_code_base64(data: str) -> str:
+    img_str = base64.b64encode(_qr_png_bytes(data)).decode("utf-8")
     return f"data:image/png;base64,{img_str}" # "data:image/png;base64," プレフィックスが付いているか
 
 # Pydanticモデル定義
 class ToolBase(BaseModel):
-    model_config = ConfigDict(populate_by_name=True) # V2の場合
+    # frozen + extra='ignore' で pydantic-core の高速パスに乗せる。
+    # extra='ignore' はシート側に列が増えてもフィールドが勝手に生えないようにする意味もある
+    model_config = ConfigDict(
+        populate_by_name=True, # V2の場合
+        frozen=True,
+        extra="ignore",
+        arbitrary_types_allowed=False,
+        validate_assignment=False,
+    )
 
     name: str = Field(..., alias="名称")
     modelNumber: Optional[str] = Field(None, alias="型番品番")
@@ -78,20 +196,33 @@ class ToolBase(BaseModel):
 
 class Tool(ToolBase):
     id: str = Field(..., alias="ID (QRコード)") # QRコードのID
-    qr_code_base64: str = Field(..., description="Base64エンコードされたQRコード画像")
+    # 一覧レスポンスでは省略し、/tools/{tool_id}/qr.png から画像として取得する
+    qr_code_base64: Optional[str] = Field(None, description="Base64エンコードされたQRコード画像")
+
+# 一覧レスポンス用のシリアライザ。モジュールレベルで1回だけ構築する
+TOOL_LIST_ADAPTER = TypeAdapter(List[Tool])
 
 class ToolUpdateStatus(BaseModel):
     status: Literal["在庫", "貸出中", "メンテナンス中", "廃棄済"] = Field(..., examples=["貸出中", "在庫"])
 
+# ヘッダーキャッシュ再読み込みエンドポイント（列構成を変更したときだけ叩く）
+@app.post("/admin/reload-headers")
+async def reload_headers():
+    """
+    キャッシュ済みのヘッダー行をスプレッドシートから再取得します。
+    """
+    try:
+        await run_in_threadpool(_load_headers)
+    except ValueError:
+        raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail="スプレッドシートに「状態」列が見つかりません。")
+    return {"header_row": HEADER_ROW}
+
 # 工具登録エンドポイント (変更なし)
 @app.post("/tools/", response_model=Tool, status_code=status.HTTP_201_CREATED)
 async def create_tool(tool_data: ToolBase):
-    all_records = master_sheet.get_all_records()
-    existing_ids = {record.get("工具治具ID") for record in all_records if record.get("工具治具ID")}
-
-    new_tool_id = f"TOOL-{datetime.datetime.now().strftime('%Y%m%d%H%M%S')}-{os.urandom(2).hex()}"
-    while new_tool_id in existing_ids:
-        new_tool_id = f"TOOL-{datetime.datetime.now().strftime('%Y%m%d%H%M%S')}-{os.urandom(2).hex()}"
+    # time_ns + ランダムサフィックスで衝突確率は無視できる（既存IDの照合も不要）。
+    # strftimeのロケール/タイムゾーン処理を通らず、時刻順に自然にソートできる
+    new_tool_id = f"TOOL-{time.time_ns()}-{secrets.token_hex(3)}"
 
     # Pydanticモデルから辞書に変換し、Google Sheetsの列名にマッピング
     # `by_alias=True` を指定してエイリアス名（日本語列名）で辞書を生成
@@ -104,11 +235,17 @@ async def create_tool(tool_data: ToolBase):
     # IDとQRコードを追加
     tool_dict_for_sheet["工具治具ID"] = new_tool_id
 
-    # ヘッダーの順番に合わせて値のリストを作成
-    header = master_sheet.row_values(1)
-    values_to_append = [tool_dict_for_sheet.get(col, "") for col in header]
+    # ヘッダーの順番に合わせて値のリストを作成（キャッシュ済みヘッダーを利用）
+    values_to_append = [tool_dict_for_sheet.get(col, "") for col in HEADER_ROW]
 
-    master_sheet.append_row(values_to_append)
+    # RAWモードの values_append 1回で書き込む（USER_ENTERED の数式パースをスキップ）
+    await run_in_threadpool(
+        spreadsheet.values_append,
+        f"{MASTER_SHEET_NAME}!A1",
+        params={"valueInputOption": "RAW", "insertDataOption": "INSERT_ROWS"},
+        body={"values": [values_to_append]},
+    )
+    invalidate_records_cache()
 
     qr_code_base64_str = generate_qr_code_base64(new_tool_id)
 
@@ -130,39 +267,27 @@ async def get_all_tools():
     """
     登録されている全ての工具・治具の一覧を取得します。
     """
-    all_records = master_sheet.get_all_records()
+    all_records = await run_in_threadpool(get_cached_records)
 
     tools_list = [] # ここで空のリストを初期化します
     for record in all_records:
-        print(f"Debug: 処理中のレコード (raw): {record}")
+        # %s形式の遅延フォーマット。DEBUGが無効なら文字列構築ごとスキップされる
+        logger.debug("処理中のレコード (raw): %s", record)
 
         tool_id = record.get("工具治具ID")
         if not tool_id:
-            print(f"Debug: '工具治具ID' が見つからないか空のレコードをスキップ: {record}")
+            logger.debug("'工具治具ID' が見つからないか空のレコードをスキップ: %s", record)
             continue
 
-        qr_code_b64 = generate_qr_code_base64(tool_id)
+        # Pydanticモデルの形式に合わせてデータを整形（対応表はインポート時に構築済み）
+        # QRコードはここでは埋め込まず、/tools/{tool_id}/qr.png で個別に配信する
+        formatted_record = _format_record(record)
+        # 自前シート由来の信頼できるデータなので、バリデータを通さず model_construct で組み立てる
+        tool_instance = Tool.model_construct(**formatted_record)
+        tools_list.append(tool_instance)
 
-        # Pydanticモデルの形式に合わせてデータを整形 (これは既に正しく英語キーに変換されています)
-        formatted_record = {
-            "id": record.get("工具治具ID"),
-            "name": record.get("名称"),
-            "modelNumber": record.get("型番品番"),
-            "type": record.get("種類"),
-            "storageLocation": record.get("保管場所"),
-            "status": record.get("状態"),
-            "purchaseDate": record.get("購入日"),
-            "purchasePrice": float(record.get("購入価格")) if record.get("購入価格") else 0.0,
-            "recommendedReplacement": record.get("推奨交換時期"),
-            "remarks": record.get("備考"),
-            "imageUrl": record.get("画像URL"),
-            "qr_code_base64": qr_code_b64
-        }
-        # 変換されたレコードをリストに追加します
-        tools_list.append(formatted_record)
-
-    # 変換済みのレコードのリストを返します
-    return tools_list
+    # dict経由のjson.dumpsを通さず、TypeAdapterで直接JSONバイト列にシリアライズして返す
+    return Response(content=TOOL_LIST_ADAPTER.dump_json(tools_list), media_type="application/json")
 
 @app.put("/tools/{tool_id}/status", response_model=Tool)
 async def update_tool_status(tool_id: str, tool_update: ToolUpdateStatus):
@@ -170,87 +295,59 @@ async def update_tool_status(tool_id: str, tool_update: ToolUpdateStatus):
     特定の工具・治具の状態を更新します。
     """
     try:
-        all_records = master_sheet.get_all_records()
-        record_found = None
-        record_row_index = -1 # Google Sheetsの行番号 (1ベース)
-
-        # ヘッダー行を考慮して1から始める
-        for i, record in enumerate(all_records):
-            if record.get("工具治具ID") == tool_id:
-                record_found = record
-                record_row_index = i + 2 # Google Sheetsは1ベース、ヘッダー行が1行目なので+2
-                break
-
-        if not record_found:
-            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="指定された工具IDが見つかりません。")
-
-        # '状態' 列のインデックスを取得 (ヘッダーから動的に取得するのが堅牢)
-        headers = master_sheet.row_values(1) # 1行目のヘッダーを取得
-        status_col_index = -1
+        # ID列だけを取得して行番号を特定する（全レコード取得はしない）
+        ids = await run_in_threadpool(master_sheet.col_values, ID_COL_INDEX)
         try:
-            status_col_index = headers.index("状態") + 1 # Google Sheetsは1ベース
+            record_row_index = ids.index(tool_id) + 1 # Google Sheetsは1ベース
         except ValueError:
-            raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail="スプレッドシートに「状態」列が見つかりません。")
-
-        # Google Sheetsのセルを更新
-        master_sheet.update_cell(record_row_index, status_col_index, tool_update.status)
-
-        # 更新後のレコードを取得して返すために、再度スプレッドシートから読み込み、整形します。
-        updated_records = master_sheet.get_all_records()
-        updated_tool_data = None
-        for record in updated_records:
-            if record.get("工具治具ID") == tool_id:
-                qr_code_b64 = generate_qr_code_base64(tool_id)
-                # Tool モデルのインスタンスを作成して返す
-                updated_tool_data = Tool(
-                    id=record.get("工具治具ID"),
-                    name=record.get("名称"),
-                    modelNumber=record.get("型番品番"),
-                    type=record.get("種類"),
-                    storageLocation=record.get("保管場所"),
-                    status=record.get("状態"),
-                    purchaseDate=record.get("購入日"),
-                    purchasePrice=float(record.get("購入価格")) if record.get("購入価格") else 0.0,
-                    recommendedReplacement=record.get("推奨交換時期"),
-                    remarks=record.get("備考"),
-                    imageUrl=record.get("画像URL"),
-                    qr_code_base64=qr_code_b64
-                )
-                break
-
-        if not updated_tool_data:
-            raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail="更新後の工具データの取得に失敗しました。")
+            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="指定された工具IDが見つかりません。")
+
+        # Google Sheetsのセルを更新（「状態」列の位置は起動時にキャッシュ済み）
+        await run_in_threadpool(master_sheet.update_cell, record_row_index, STATUS_COL_INDEX, tool_update.status)
+        invalidate_records_cache()
+
+        # 更新後の1行だけを読み直し、キャッシュ済みヘッダーと突き合わせて整形する
+        row = await run_in_threadpool(master_sheet.row_values, record_row_index)
+        record = dict(zip(HEADER_ROW, row))
+
+        qr_code_b64 = generate_qr_code_base64(tool_id)
+        # Tool モデルのインスタンスを作成して返す
+        formatted = _format_record(record)
+        formatted["status"] = tool_update.status
+        formatted["qr_code_base64"] = qr_code_b64
+        # 自前シート由来の信頼できるデータなので model_construct でバリデーションを省く
+        updated_tool_data = Tool.model_construct(**formatted)
 
         return updated_tool_data
 
     except HTTPException as e:
         raise e
     except Exception as e:
-        print(f"工具状態更新エラー: {e}")
+        logger.error("工具状態更新エラー: %s", e)
         raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=f"工具の状態更新中にエラーが発生しました: {e}")
 
+@app.get("/tools/{tool_id}/qr.png")
+async def get_tool_qr_png(tool_id: str):
+    """
+    特定の工具・治具のQRコードをPNG画像として返します。
+
+    IDは不変なのでブラウザ/CDNで恒久キャッシュ可能。
+    """
+    return Response(
+        content=_qr_png_bytes(tool_id),
+        media_type="image/png",
+        headers={"Cache-Control": "public, max-age=31536000, immutable"},
+    )
+
 @app.get("/tools/{tool_id}", response_model=Tool)
 async def get_tool_by_id(tool_id: str):
     """
     特定の工具・治具の詳細情報をIDで取得します。
     """
-    all_records = master_sheet.get_all_records()
+    all_records = await run_in_threadpool(get_cached_records)
     for record in all_records:
         if record.get("工具治具ID") == tool_id:
             qr_code_b64 = generate_qr_code_base64(tool_id)
-            # Tool モデルのインスタンスを作成して返す
-            return Tool(
-                id=record.get("工具治具ID"),
-                name=record.get("名称"),
-                modelNumber=record.get("型番品番"),
-                type=record.get("種類"),
-                storageLocation=record.get("保管場所"),
-                status=record.get("状態"),
-                purchaseDate=record.get("購入日"),
-                purchasePrice=float(record.get("購入価格")) if record.get("購入価格") else 0.0,
-                recommendedReplacement=record.get("推奨交換時期"),
-                remarks=record.get("備考"),
-                imageUrl=record.get("画像URL"),
-                qr_code_base64=qr_code_b64
-            )
+            # Tool モデルのインスタンスを作成して返す（シート由来データなのでバリデーション不要）
+            return Tool.model_construct(**_format_record(record), qr_code_base64=qr_code_b64)
     raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="指定された工具IDが見つかりません。")
\ No newline at end of file